@@ -0,0 +1,214 @@
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+from fastapi import HTTPException
+
+from app._helpers import estimate_tokens
+
+# fixed prompt overhead of one upstream call (system prompt and instruction)
+CALL_OVERHEAD_TOKENS = 80
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available, 0 if they are now."""
+        self._refill()
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class _Ticket:
+    __slots__ = ("granted",)
+
+    def __init__(self):
+        self.granted = False
+
+
+def estimate_cost(texts: list[str]) -> int:
+    """Estimate the prompt plus completion tokens needed to translate `texts`."""
+    tokens = sum(estimate_tokens(str(text)) for text in texts)
+    # the translation is about as long as the source
+    return 2 * tokens + CALL_OVERHEAD_TOKENS
+
+
+class AdmissionController:
+    """Per-key token accounting and admission control for upstream LLM calls.
+
+    Every caller key has a token bucket refilled at `key_rate` tokens per
+    minute, and all keys share an upstream bucket of `upstream_rate`. A request
+    is charged its estimated cost up front and the difference to the usage
+    reported by the model afterwards. At most `max_concurrent` requests call
+    upstream at once; waiting requests are served round-robin between keys so
+    one busy key cannot starve the others. Requests that cannot be served are
+    rejected at once with 429 (key budget) or 503 (upstream budget or queue
+    timeout) and a Retry-After header.
+    """
+
+    def __init__(
+        self,
+        key_rate: int = 100000,
+        upstream_rate: int = 1000000,
+        max_concurrent: int = 8,
+        queue_timeout: float = 30.0,
+    ):
+        self.key_rate = key_rate
+        self.upstream = TokenBucket(upstream_rate / 60, upstream_rate)
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self._buckets: dict[str, TokenBucket] = {}
+        self._ledger: dict[str, dict] = {}
+        self._lock = Lock()
+        self._condition = Condition()
+        self._active = 0
+        self._queues: OrderedDict[str, deque] = OrderedDict()
+
+    def _bucket(self, key: str) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.key_rate / 60, self.key_rate)
+        return bucket
+
+    def _account(self, key: str) -> dict:
+        account = self._ledger.get(key)
+        if account is None:
+            account = self._ledger[key] = {
+                "requests": 0,
+                "rejected": 0,
+                "estimated_tokens": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+            }
+        return account
+
+    def _reject(self, key: str, status_code: int, detail: str, retry_after: float):
+        self._account(key)["rejected"] += 1
+        raise HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+    def _charge(self, key: str, estimate: int) -> int:
+        with self._lock:
+            bucket = self._bucket(key)
+            # a request larger than the whole budget waits for a full bucket
+            # and leaves the key in debt once its real usage is settled
+            estimate = min(estimate, bucket.capacity, self.upstream.capacity)
+            wait = bucket.wait_time(estimate)
+            if wait:
+                self._reject(key, 429, "Token budget exhausted.", wait)
+            wait = self.upstream.wait_time(estimate)
+            if wait:
+                self._reject(key, 503, "Upstream token budget exhausted.", wait)
+            bucket.take(estimate)
+            self.upstream.take(estimate)
+            account = self._account(key)
+            account["requests"] += 1
+            account["estimated_tokens"] += estimate
+            return estimate
+
+    def _settle(self, key: str, estimate: int, report: dict):
+        used = report.get("prompt_tokens", 0) + report.get("completion_tokens", 0)
+        with self._lock:
+            account = self._account(key)
+            account["prompt_tokens"] += report.get("prompt_tokens", 0)
+            account["completion_tokens"] += report.get("completion_tokens", 0)
+            # refund or debit the difference between estimate and usage
+            self._bucket(key).take(used - estimate)
+            self.upstream.take(used - estimate)
+
+    def _acquire(self, key: str):
+        with self._condition:
+            if self._active < self.max_concurrent and not self._queues:
+                self._active += 1
+                return
+            ticket = _Ticket()
+            self._queues.setdefault(key, deque()).append(ticket)
+            deadline = time.monotonic() + self.queue_timeout
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    queue = self._queues[key]
+                    queue.remove(ticket)
+                    if not queue:
+                        del self._queues[key]
+                    self._reject(key, 503, "Upstream busy.", self.queue_timeout)
+                self._condition.wait(remaining)
+
+    def _release(self):
+        with self._condition:
+            self._active -= 1
+            while self._active < self.max_concurrent and self._queues:
+                # grant the head of the next key's queue, then rotate that key
+                # to the back
+                key, queue = self._queues.popitem(last=False)
+                queue.popleft().granted = True
+                self._active += 1
+                if queue:
+                    self._queues[key] = queue
+            self._condition.notify_all()
+
+    @contextmanager
+    def admit(self, key: str, estimate: int):
+        """Admit one upstream-bound request of `key` costing about `estimate` tokens.
+
+        Yields a report dictionary for the translation helpers to fill with
+        the model's token usage, which is charged to `key` on exit.
+        """
+        estimate = self._charge(key, estimate)
+        report = {}
+        try:
+            self._acquire(key)
+        except HTTPException:
+            self._settle(key, estimate, report)
+            raise
+        try:
+            yield report
+        finally:
+            self._release()
+            self._settle(key, estimate, report)
+
+    def _upstream_available(self) -> int:
+        self.upstream.wait_time(0)
+        return int(self.upstream.tokens)
+
+    def stats(self) -> dict:
+        with self._condition:
+            queued = sum(len(queue) for queue in self._queues.values())
+        with self._lock:
+            return {
+                "active": self._active,
+                "queued": queued,
+                "upstream_tokens_available": self._upstream_available(),
+                "keys": {key: dict(account) for key, account in self._ledger.items()},
+            }
+
+
+admission = AdmissionController(
+    key_rate=int(os.getenv("TOKEN_BUDGET_PER_MINUTE", "100000")),
+    upstream_rate=int(os.getenv("UPSTREAM_TOKENS_PER_MINUTE", "1000000")),
+    max_concurrent=int(os.getenv("UPSTREAM_MAX_CONCURRENT", "8")),
+    queue_timeout=float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "30")),
+)
@@ -0,0 +1,60 @@
+import hashlib
+import os
+
+import orjson
+from fastapi import Request, Response
+
+from app.__exceptions import ExceptionList
+from app._encoding import FastJSONResponse
+from app._info import __version__
+
+CACHE_MAX_AGE = int(os.getenv("CACHE_MAX_AGE", "86400"))
+
+# Outputs change when the exception list or the code changes, so both are
+# folded into every ETag.
+EXCEPTIONS_VERSION = hashlib.sha256(orjson.dumps(ExceptionList)).hexdigest()[:16]
+
+
+def make_etag(route: str, *inputs) -> str:
+    """Build an ETag from everything a deterministic route's output depends on.
+
+    The tag is weak because GZipMiddleware serves the same JSON with or
+    without gzip content-coding, and a strong tag must differ between them.
+    """
+    digest = hashlib.blake2b(
+        orjson.dumps([route, __version__, EXCEPTIONS_VERSION, *inputs]),
+        digest_size=16,
+    ).hexdigest()
+    return f'W/"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison function
+    candidates = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag.removeprefix("W/") in candidates
+
+
+def cached_response(request: Request, etag: str, compute) -> Response:
+    """Answer a GET with 304 when the client already has `etag`, else run `compute`.
+
+    Because the ETag is derived from the inputs, a matching request skips the
+    computation entirely. GET responses are also marked cacheable for
+    `CACHE_MAX_AGE` seconds. Other methods are answered without validators,
+    since 304 is only defined for GET and HEAD.
+    """
+    if request.method not in ("GET", "HEAD"):
+        return FastJSONResponse(compute())
+
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={CACHE_MAX_AGE}",
+        "Vary": "Authorization",
+    }
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse(compute(), headers=headers)
@@ -0,0 +1,155 @@
+import hashlib
+import os
+from collections import OrderedDict
+from contextlib import nullcontext
+from threading import Lock
+
+from app._helpers import TranslationError, transform_line, translate_texts
+
+
+def line_key(line: str, target: str) -> bytes:
+    return hashlib.blake2b(f"{target}\0{line}".encode(), digest_size=16).digest()
+
+
+class Document:
+    """Lines of a submitted document and the results computed for them.
+
+    `results` maps `line_key` to (transformed line, translated) where
+    `translated` tells whether the translation can be reused as is.
+    """
+
+    def __init__(self, lines: list[str], results: dict):
+        self.lines = lines
+        self.results = results
+
+
+class DocumentIndex:
+    """Bounded LRU of documents keyed by the client's document id."""
+
+    def __init__(self, max_documents: int = 256):
+        self.max_documents = max_documents
+        self._documents = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, document_id: str) -> Document | None:
+        with self._lock:
+            document = self._documents.get(document_id)
+            if document is not None:
+                self._documents.move_to_end(document_id)
+            return document
+
+    def put(self, document_id: str, document: Document):
+        with self._lock:
+            self._documents[document_id] = document
+            self._documents.move_to_end(document_id)
+            if len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"documents": len(self._documents), "max_documents": self.max_documents}
+
+
+document_index = DocumentIndex(int(os.getenv("DOCUMENT_INDEX_SIZE", "256")))
+
+
+def apply_edits(lines: list[str], edits: list) -> list[str]:
+    """Apply line splices in order; each edit replaces lines[start:end]."""
+    lines = list(lines)
+    for edit in edits:
+        if not 0 <= edit.start <= edit.end <= len(lines):
+            raise ValueError(
+                f"Edit range {edit.start}:{edit.end} outside document of {len(lines)} lines"
+            )
+        lines[edit.start : edit.end] = [line for line in edit.lines if line != ""]
+    return lines
+
+
+def iter_lines(text: str):
+    """Yield the non-empty lines of `text` one at a time without splitting it."""
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start)
+        if end == -1:
+            end = len(text)
+        if end > start:
+            yield text[start:end]
+        start = end + 1
+
+
+def iter_batches(lines, max_chars: int):
+    """Group lines into lists of at least `max_chars` characters, except the last."""
+    batch = []
+    size = 0
+    for line in lines:
+        batch.append(line)
+        size += len(line)
+        if size >= max_chars:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def transform_lines(
+    lines: list[str],
+    target: str,
+    previous: dict | None = None,
+    admit=None,
+    translate: bool = True,
+) -> tuple[list[dict], dict, int]:
+    """Transform and translate lines, reusing results from a previous submission.
+
+    Only lines without a previous result are tagged, and only lines without a
+    reusable translation are sent to `translate_texts`, once per distinct line.
+    When the translation fails the lines keep no translation and are not
+    marked reusable, so the next submission retries them.
+
+    Args:
+        lines: Non-empty lines of the document
+        target: The target language code
+        previous: `Document.results` of the previous submission, if any
+        admit: Optional callable taking the lines to translate and returning
+            a context manager that yields the report for `translate_texts`.
+            It is entered only around the translation, after all tagging.
+        translate: Whether to translate the lines or only tag them
+
+    Returns:
+        (transformed lines in input order, results to store for the document,
+        number of lines reused without tagging)
+    """
+    previous = previous or {}
+    results = {}
+    pending = []
+    reused = 0
+    for line in lines:
+        key = line_key(line, target)
+        if key in results:
+            continue
+        if key in previous:
+            results[key] = previous[key]
+            reused += 1
+            if previous[key][1]:
+                continue
+        else:
+            results[key] = (transform_line(line), False)
+        pending.append((key, line))
+
+    if not translate:
+        pending = []
+    if pending:
+        texts = [line for _, line in pending]
+        try:
+            with admit(texts) if admit else nullcontext({}) as report:
+                translations = translate_texts(texts, target, report=report)
+        except TranslationError:
+            translations = None
+        if translations is not None:
+            for (key, _), translation in zip(pending, translations):
+                results[key] = (
+                    {**results[key][0], "translation": str(translation)},
+                    True,
+                )
+
+    transformed = [results[line_key(line, target)][0] for line in lines]
+    return transformed, results, reused
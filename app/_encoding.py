@@ -0,0 +1,59 @@
+import base64
+
+import orjson
+from fastapi.responses import JSONResponse
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson instead of the stdlib encoder."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+def pack_flags(flags: list[bool]) -> str:
+    """Pack booleans into a base64 bitfield, least significant bit first.
+
+    Flag ``i`` lives in bit ``i % 8`` of byte ``i // 8``.
+    """
+    packed = bytearray((len(flags) + 7) // 8)
+    for i, flag in enumerate(flags):
+        if flag:
+            packed[i >> 3] |= 1 << (i & 7)
+    return base64.b64encode(packed).decode("ascii")
+
+
+def columnar_line(line: dict) -> dict:
+    """Convert a `transform_line` result into parallel arrays.
+
+    Args:
+        line: Dictionary returned by `transform_line`
+
+    Returns:
+        Dictionary with structure:
+        {
+            "origin": original text,
+            "translation": translation or null,
+            "text": [surface, ...],
+            "furigana": [kana or null, ...],
+            "space": base64 bitfield of space flags (see `pack_flags`)
+        }
+    """
+    words = line["words"]
+    return {
+        "origin": line["origin"],
+        "translation": line["translation"],
+        "text": [word["text"] for word in words],
+        "furigana": [word["furigana"] for word in words],
+        "space": pack_flags([word["space"] for word in words]),
+    }
+
+
+def token_offsets(text: str) -> list[int]:
+    """Return the start offset of every space-separated token in `text`."""
+    offsets = [0]
+    position = text.find(" ")
+    while position != -1:
+        offsets.append(position + 1)
+        position = text.find(" ", position + 1)
+    return offsets
@@ -0,0 +1,94 @@
+import asyncio
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from fastapi import HTTPException
+
+
+class BoundedExecutor:
+    """Thread pool with a bounded queue for one class of work.
+
+    At most `workers` calls run at once and at most `queue_limit` more wait for
+    a thread. Calls beyond that are rejected immediately with 503 instead of
+    queuing without bound, so one slow workload cannot hold the threads that
+    another needs.
+    """
+
+    def __init__(self, name: str, workers: int, queue_limit: int):
+        self.name = name
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._lock = Lock()
+        self._pending = 0
+        self._running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _task(self, queued: float, fn, args, kwargs):
+        waited = time.monotonic() - queued
+        with self._lock:
+            self._running += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self.completed += 1
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        """Run `fn(*args, **kwargs)` in the pool and await its result."""
+        with self._lock:
+            if self._pending >= self.workers + self.queue_limit:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="Server busy, try again later.",
+                    headers={"Retry-After": "1"},
+                )
+            self._pending += 1
+        context = contextvars.copy_context()
+        future = self._pool.submit(
+            context.run, self._task, time.monotonic(), fn, args, kwargs
+        )
+        future.add_done_callback(self._done)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            started = self.completed + self._running
+            return {
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "running": self._running,
+                "queued": self._pending - self._running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_wait_ms": 1000 * self.total_wait / started if started else 0.0,
+                "max_wait_ms": 1000 * self.max_wait,
+            }
+
+
+# tagging and romanization, milliseconds of CPU per request
+cpu_executor = BoundedExecutor(
+    "cpu",
+    int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 1))),
+    int(os.getenv("CPU_QUEUE_LIMIT", "64")),
+)
+# calls waiting on OpenRouter or worldnewsapi
+io_executor = BoundedExecutor(
+    "upstream",
+    int(os.getenv("IO_WORKERS", "32")),
+    int(os.getenv("IO_QUEUE_LIMIT", "64")),
+)
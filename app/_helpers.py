@@ -1,32 +1,80 @@
+import html
 import os
+import re
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.gzip import GZipMiddleware
 from html.parser import HTMLParser
 from app.rate_limiter import authenticated
+from app._encoding import FastJSONResponse
+
+app = FastAPI(default_response_class=FastJSONResponse)
+app.add_middleware(
+    GZipMiddleware, minimum_size=int(os.getenv("GZIP_MINIMUM_SIZE", "1024"))
+)
 
-app = FastAPI()
 
+def free_limit_not_exceeded(request: Request, text: str | None = None, limit=350):
+    """Check the size of a free request's input against `limit` bytes.
 
-def free_limit_not_exceeded(request: Request, limit=350):
+    The Content-Length is used when present. GET variants carry their input in
+    the query string; other requests without a Content-Length (chunked
+    bodies) are measured by their parsed input `text` and rejected when it
+    is not given.
+    """
     length = request.headers.get("Content-Length")
-    return int(length) < limit
+    if length is not None:
+        return int(length) < limit
+    if request.method == "GET":
+        return len(request.url.query) < limit
+    if text is not None:
+        return len(text.encode()) < limit
+    return False
 
 
-def request_allowed(request: Request):
+def request_allowed(request: Request, text: str | None = None):
     if authenticated(request):
         return True
-    elif free_limit_not_exceeded(request):
+    elif free_limit_not_exceeded(request, text):
         return True
     else:
         raise HTTPException(status_code=413, detail="Payload too large for free user")
 
 
-def process_html(html_string, callback):
+# CJK symbols and punctuation, kana, ideographs and full-width forms; text
+# without any of these is left alone by the tagger
+JAPANESE_PATTERN = re.compile(r"[\u3000-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+# Elements whose text is passed through untouched by `process_html`
+SKIP_TAGS = frozenset(
+    tag.strip().lower()
+    for tag in os.getenv("HTML_SKIP_TAGS", "script,style,code").split(",")
+    if tag.strip()
+)
+
+
+def has_japanese(text: str) -> bool:
+    """Check if a text contains anything the Japanese tagger would convert."""
+    return JAPANESE_PATTERN.search(text) is not None
+
+
+def process_html(html_string, callback, skip_tags=SKIP_TAGS):
+    """Rebuild an HTML string with `callback` applied to its text nodes.
+
+    Whitespace-only nodes are dropped, nodes without Japanese text are kept
+    as they are without calling `callback`, and the contents of `skip_tags`
+    elements are not converted. Text that is kept is re-escaped, since the
+    parser has already decoded its entities.
+    """
+
     class CallbackParser(HTMLParser):
         def __init__(self, callback):
             super().__init__()
             self.callback = callback
             self.result = ""
             self.name_stack = []
+            # open `skip_tags` elements; counted apart from `name_stack`,
+            # which void tags leave unbalanced
+            self.skip_depth = 0
 
         def handle_starttag(self, name, attrs):
             if name in ["img", "input", "br", "hr", "meta"]:
@@ -40,15 +88,31 @@ def process_html(html_string, callback):
                     self.result += " " + attr[0] + '="' + attr[1] + '"'
                 self.result += ">"
             self.name_stack.append(name)
+            if name in skip_tags:
+                self.skip_depth += 1
 
         def handle_endtag(self, name):
+            if name in skip_tags and self.skip_depth:
+                self.skip_depth -= 1
             current_name = self.name_stack.pop()
             if self.name_stack and self.name_stack[-1] != current_name:
                 self.result += " "
             self.result += "</" + name + ">"
 
         def handle_data(self, data):
-            data = self.callback(data)
+            # the parser has decoded entities, so text copied through is
+            # escaped again, except inside script and style
+            if self.skip_depth:
+                self.result += (
+                    data if self.cdata_elem else html.escape(data, quote=False)
+                )
+                return
+            if not data.strip():
+                return
+            if has_japanese(data):
+                data = self.callback(data)
+            elif not self.cdata_elem:
+                data = html.escape(data, quote=False)
             if data:
                 # Append leading and trailing whitespace to match the original string
                 self.result += data.strip() + " "
@@ -73,6 +137,19 @@ def process_html(html_string, callback):
     return parser.get_result()
 
 
+def romaji_markup(katsu):
+    """`process_html` callback replacing a text node by its escaped romaji."""
+    return lambda text: html.escape(katsu.romaji(text), quote=False)
+
+
+def furigana_markup(katsu):
+    """`process_html` callback annotating a text node with its romaji."""
+    return lambda text: (
+        f"<ruby>{html.escape(text, quote=False)}"
+        f"<rt>{html.escape(katsu.romaji(text), quote=False)}<rt></ruby>"
+    )
+
+
 import worldnewsapi
 from worldnewsapi.models.retrieve_newspaper_front_page200_response import (
     RetrieveNewspaperFrontPage200Response,
@@ -123,6 +200,9 @@ def fetch_news(categories: list[str], num=20):
 import json
 from typing import Optional, Dict, List
 from openai import OpenAI
+from app._translation_memory import translation_memory
+
+TRANSLATION_MODEL = os.getenv("OPENROUTER_MODEL", "deepseek/deepseek-chat:free")
 
 # ISO 639-1 language codes (common subset)
 LANGUAGE_CODES: Dict[str, str] = {
@@ -220,7 +300,11 @@ def split_text_into_chunks(text: str, max_size: int = 120000) -> List[str]:
 
 
 def translate_text(
-    text: str, target_lang: str, source_lang: Optional[str] = None, chunk_size=50000
+    text: str,
+    target_lang: str,
+    source_lang: Optional[str] = None,
+    chunk_size=50000,
+    report: Optional[dict] = None,
 ) -> str | None:
     """
     Translate text using OpenAI's API via OpenRouter.
@@ -232,6 +316,7 @@ def translate_text(
         source_lang: Optional source language code (e.g., 'en' for English)
                     If not provided, the model will attempt to detect the language.
         chunk_size: Maximum size of each chunk in characters
+        report: Optional dictionary filled with the tokens used
 
     Returns:
         str|None : translated text
@@ -266,6 +351,10 @@ def translate_text(
         },
     )
 
+    if report is None:
+        report = {}
+    report.update(prompt_tokens=0, completion_tokens=0)
+
     # Split text into chunks if necessary
     chunks = split_text_into_chunks(text, chunk_size)
     translated_chunks = []
@@ -280,7 +369,7 @@ def translate_text(
 
             # Make the API request using the OpenAI SDK
             response = client.chat.completions.create(
-                model="deepseek/deepseek-chat:free",
+                model=TRANSLATION_MODEL,
                 messages=[
                     {
                         "role": "system",
@@ -290,6 +379,10 @@ def translate_text(
                 ],
             )
 
+            if getattr(response, "usage", None):
+                report["prompt_tokens"] += response.usage.prompt_tokens or 0
+                report["completion_tokens"] += response.usage.completion_tokens or 0
+
             # Extract the translated text
             translated_chunk = response.choices[0].message.content.strip()
             translated_chunks.append(translated_chunk)
@@ -304,15 +397,59 @@ def translate_text(
     return translated_text
 
 
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the number of LLM tokens in a text.
+
+    CJK characters are counted as one token each and other characters as one
+    token per four, which is close enough to compare prompt sizes.
+    """
+    wide = sum(1 for char in text if ord(char) >= 0x3000)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def _short_id(n: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = digits[n % 36]
+    while n >= 36:
+        n //= 36
+        out = digits[n % 36] + out
+    return out
+
+
 def translate_array(
     texts: list[str],
     target_lang: str,
     source_lang: Optional[str] = None,
     chunk_size=50000,
+    report: Optional[dict] = None,
+) -> list[str | None]:
+    """Translate an array of texts like `translate_texts`, without raising.
+
+    Returns:
+        The translations in input order, an empty list when no API key is
+        configured, or a single-element list holding the error message.
+        Callers that need to tell a failure apart from the translation of a
+        single text use `translate_texts` instead.
+    """
+    if not os.getenv("OPENROUTER_API_KEY"):
+        return []
+    try:
+        return translate_texts(texts, target_lang, source_lang, chunk_size, report)
+    except TranslationError as e:
+        return [str(e)]
+
+
+def translate_texts(
+    texts: list[str],
+    target_lang: str,
+    source_lang: Optional[str] = None,
+    chunk_size=50000,
+    report: Optional[dict] = None,
 ) -> list[str | None]:
     """
     Translate an array of texts using OpenAI's API via OpenRouter.
-    Joins texts into a single request and splits into chunks if necessary.
+    Identical texts are translated once and texts are packed into as few
+    requests as possible, split into chunks if necessary.
 
     Args:
         texts: List of texts to translate
@@ -320,11 +457,18 @@ def translate_array(
         source_lang: Optional source language code (e.g., 'en' for English)
                     If not provided, the model will attempt to detect the language.
         chunk_size: Maximum size of each chunk in characters
+        report: Optional dictionary filled with the number of inputs, unique
+                texts and memory hits, the tokens used, and the estimated prompt
+                and completion tokens saved compared to sending every input
+                as a numbered list
 
     Returns:
-        list[str|None]: A list of translated texts.
+        list[str]: A list of translated texts.
                                 The order of translations matches the input array order.
 
+    Raises:
+        TranslationError: If the API key is missing or any group could not
+                          be translated
     """
     if not texts:
         return []
@@ -346,7 +490,7 @@ def translate_array(
     # Get API key from environment variable
     api_key = os.getenv("OPENROUTER_API_KEY")
     if not api_key:
-        return []
+        raise TranslationError("Translation unavailable")
 
     # Initialize OpenAI client with OpenRouter base URL
     client = OpenAI(
@@ -357,16 +501,45 @@ def translate_array(
         },
     )
 
-    # for text in texts:
+    texts = [str(text) for text in texts]
+    all_translations: list[str | None] = [None] * len(texts)
+    if report is None:
+        report = {}
+    report.update(
+        inputs=len(texts),
+        unique=0,
+        memory_hits=0,
+        prompt_tokens=0,
+        completion_tokens=0,
+    )
+
+    # Identical texts are translated once and fanned back out to every position
+    positions: dict[str, list[int]] = {}
+    for idx, text in enumerate(texts):
+        positions.setdefault(text, []).append(idx)
+    report["unique"] = len(positions)
+
+    # Near-duplicates of earlier sentences are answered from the translation
+    # memory, or their earlier translation is given to the model as reference
+    references = {}
+    pending = []
+    for text, indices in positions.items():
+        match = translation_memory.lookup(text, target_lang)
+        if match and match.direct:
+            for idx in indices:
+                all_translations[idx] = match.translation
+            report["memory_hits"] += 1
+            continue
+        if match:
+            references[text] = match
+        pending.append(text)
 
     # Split texts into smaller groups to avoid overwhelming the model
     text_groups = []
     current_group = []
     current_size = 0
-    # try:
 
-    for text in texts:
-        text = str(text)
+    for text in pending:
         text_size = len(text)
         if current_size + text_size > chunk_size // 2:  # Use half max size for safety
             if current_group:
@@ -376,54 +549,74 @@ def translate_array(
         else:
             current_group.append(text)
             current_size += text_size
-        #
     if current_group:
         text_groups.append(current_group)
 
-    all_translations = []
-
+    packed_prompt_tokens = 0
+    packed_completion_tokens = 0
     for group_idx, text_group in enumerate(text_groups, 1):
-        # Format texts in this group as a numbered list
-        formatted_texts = "\n".join(
-            f"{i+1}. {text}" for i, text in enumerate(text_group)
+        # Key texts in this group by short ids in a compact JSON object
+        ids = [_short_id(i) for i in range(len(text_group))]
+        formatted_texts = json.dumps(
+            dict(zip(ids, text_group)), ensure_ascii=False, separators=(",", ":")
         )
+        packed_prompt_tokens += estimate_tokens(formatted_texts)
 
         # Prepare the prompt using full language names for better model understanding
-        instruction = f"Translate each of the following numbered texts to {LANGUAGE_CODES[target_lang]}"
+        instruction = f"Translate the values to {LANGUAGE_CODES[target_lang]}"
         if source_lang:
             instruction += f" from {LANGUAGE_CODES[source_lang]}"
-        instruction += (
-            ". Return only the translations as a JSON array in the exact same order:"
-        )
+        if any(PLACEHOLDER_PATTERN.search(text) for text in text_group):
+            instruction += ". Keep the keys and the <gN>, </gN> and <xN/> tags:"
+        else:
+            instruction += ". Keep the keys:"
+
+        group_references = [
+            references[text] for text in text_group if text in references
+        ]
+        if group_references:
+            formatted_texts += (
+                "\n\nTranslations of similar texts, for reference only:\n"
+            )
+            formatted_texts += "\n".join(
+                f"- {match.source} => {match.translation}" for match in group_references
+            )
 
         try:
             # Make the API request using the OpenAI SDK
             response = client.chat.completions.create(
-                model="deepseek/deepseek-chat:free",
+                model=TRANSLATION_MODEL,
                 messages=[
                     {
                         "role": "system",
-                        "content": 'You are a highly accurate translation assistant. Return ONLY a JSON array containing the translated texts in order, with no additional text or explanations. Example format: ["translation1", "translation2"]',
+                        "content": 'You are a highly accurate translation assistant. Return ONLY a JSON object mapping each key to its translation, with no additional text or explanations. Example format: {"0":"translation1","1":"translation2"}',
                     },
                     {"role": "user", "content": f"{instruction}\n\n{formatted_texts}"},
                 ],
                 response_format={"type": "json_object"},
                 temperature=0.1,  # Lower temperature for more consistent JSON formatting
             )
+            if getattr(response, "usage", None):
+                report["prompt_tokens"] += response.usage.prompt_tokens or 0
+                report["completion_tokens"] += response.usage.completion_tokens or 0
 
             # Extract and parse the JSON response
             response_content = response.choices[0].message.content.strip()
+            packed_completion_tokens += estimate_tokens(response_content)
 
             # Try to parse the raw JSON response
             translations = json.loads(response_content)
 
             # Handle different response formats
             if isinstance(translations, dict):
-                # If it's a dictionary, look for translations in known fields
-                translations = translations.get(
-                    "translations",
-                    translations.get("results", translations.get("text", [])),
-                )
+                if all(key in translations for key in ids):
+                    translations = [translations[key] for key in ids]
+                else:
+                    # If it's a dictionary, look for translations in known fields
+                    translations = translations.get(
+                        "translations",
+                        translations.get("results", translations.get("text", [])),
+                    )
             elif not isinstance(translations, list):
                 # If it's not a list or dict, try to convert to list
                 translations = [translations] if translations else []
@@ -432,35 +625,236 @@ def translate_array(
             translations = [str(t).strip() for t in translations]
 
             if len(translations) != len(text_group):
-                return [
+                raise TranslationError(
                     f"ERR: Expected {len(text_group)} translations in group {group_idx}, got {len(translations)}"
-                ]
+                )
 
-            all_translations.extend(translations)
+            for text, translation in zip(text_group, translations):
+                for idx in positions[text]:
+                    all_translations[idx] = translation
+                translation_memory.add(text, target_lang, translation)
 
+        except TranslationError:
+            raise
         except json.JSONDecodeError as e:
-            return [
+            raise TranslationError(
                 f"Invalid JSON response in group {group_idx}: {str(e)}\nResponse content: {response_content}"
-            ]
+            )
         except Exception as e:
-            return [f"ERR: {str(e)}"]
+            raise TranslationError(f"ERR: {str(e)}")
 
     # Verify final number of translations
-    if len(all_translations) != len(texts):
-        return [
-            f"ERR: Expected {len(texts)} total translations, got {len(all_translations)}"
-        ]
+    missing = all_translations.count(None)
+    if missing:
+        raise TranslationError(
+            f"ERR: Expected {len(texts)} total translations, got {len(texts) - missing}"
+        )
 
+    # Compare with a numbered list of every input answered by a JSON array
+    report["prompt_tokens_saved"] = (
+        sum(estimate_tokens(f"{i+1}. {text}\n") for i, text in enumerate(texts))
+        - packed_prompt_tokens
+    )
+    report["completion_tokens_saved"] = (
+        estimate_tokens(json.dumps(all_translations, ensure_ascii=False))
+        - packed_completion_tokens
+    )
     return all_translations
 
 
+# ================================== #
+# HTML translation
+# ================================== #
+
+# Elements translated as part of the surrounding sentence, as placeholders
+INLINE_TAGS = frozenset(
+    "a abbr b bdi bdo cite data dfn em font i kbd mark q rb rp rt ruby s samp "
+    "small span strong sub sup time u var".split()
+)
+VOID_TAGS = frozenset(["br", "img", "wbr"])
+PLACEHOLDER_PATTERN = re.compile(r"</?g\d+>|<x\d+/>")
+
+
+class _HtmlSegmenter(HTMLParser):
+    """Split HTML into markup that is kept and text units that are translated.
+
+    A unit is a run of text and inline elements between block-level tags.
+    Inline tags inside it are replaced by numbered placeholders (`<g1>`,
+    `</g1>`, `<x2/>`) so that the whole sentence is translated at once.
+    """
+
+    def __init__(self, skip_tags):
+        super().__init__()
+        self.skip_tags = skip_tags
+        # markup strings and indexes into `units`
+        self.parts: list = []
+        # (source text with placeholders, {placeholder: original markup})
+        self.units: list[tuple[str, dict]] = []
+        self.name_stack = []
+        self._unit = []
+        self._tags = {}
+        self._open = []
+
+    def _skipping(self):
+        return any(name in self.skip_tags for name in self.name_stack)
+
+    def _flush(self):
+        text = "".join(self._unit)
+        if any(char.isalpha() for char in PLACEHOLDER_PATTERN.sub("", text)):
+            self.parts.append(len(self.units))
+            self.units.append((text, self._tags))
+        elif text:
+            self.parts.append(_restore_markup(text, self._tags))
+        self._unit = []
+        self._tags = {}
+        self._open = []
+
+    def _placeholder(self, placeholder, markup):
+        self._tags[placeholder] = markup
+        self._unit.append(placeholder)
+
+    def _markup(self, markup):
+        self._flush()
+        self.parts.append(markup)
+
+    def handle_starttag(self, tag, attrs):
+        markup = self.get_starttag_text()
+        if self._skipping() or (tag not in INLINE_TAGS and tag not in VOID_TAGS):
+            self._markup(markup)
+        elif tag in VOID_TAGS:
+            self._placeholder(f"<x{len(self._tags) + 1}/>", markup)
+            return
+        else:
+            number = len(self._tags) + 1
+            self._open.append((tag, number))
+            self._placeholder(f"<g{number}>", markup)
+        self.name_stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        markup = self.get_starttag_text()
+        if self._skipping() or tag not in INLINE_TAGS | VOID_TAGS:
+            self._markup(markup)
+        else:
+            self._placeholder(f"<x{len(self._tags) + 1}/>", markup)
+
+    def handle_endtag(self, tag):
+        if tag in self.name_stack:
+            while self.name_stack and self.name_stack.pop() != tag:
+                pass
+        for i in range(len(self._open) - 1, -1, -1):
+            if self._open[i][0] == tag:
+                number = self._open.pop(i)[1]
+                self._placeholder(f"</g{number}>", f"</{tag}>")
+                return
+        self._markup(f"</{tag}>")
+
+    def handle_data(self, data):
+        if self.cdata_elem or self._skipping():
+            self._markup(data if self.cdata_elem else html.escape(data, quote=False))
+        else:
+            self._unit.append(data)
+
+    def handle_comment(self, data):
+        self._markup(f"<!--{data}-->")
+
+    def handle_decl(self, decl):
+        self._markup(f"<!{decl}>")
+
+    def handle_pi(self, data):
+        self._markup(f"<?{data}>")
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+def _rebuild_unit(source: str, tags: dict, translation: str) -> str:
+    """Put the original markup back into a translated unit."""
+    leading = source[: len(source) - len(source.lstrip())]
+    trailing = source[len(source.rstrip()) :]
+    translation = translation.strip()
+
+    found = PLACEHOLDER_PATTERN.findall(translation)
+    if sorted(found) != sorted(tags):
+        # the model lost or invented placeholders: keep every tag, in source
+        # order, ahead of the plain translated text
+        text = html.escape(PLACEHOLDER_PATTERN.sub("", translation), quote=False)
+        return leading + "".join(tags.values()) + text + trailing
+
+    return leading + _restore_markup(translation, tags) + trailing
+
+
+def _restore_markup(text: str, tags: dict) -> str:
+    """Escape the text of a unit and replace its placeholders with markup."""
+    pieces = []
+    position = 0
+    for match in PLACEHOLDER_PATTERN.finditer(text):
+        pieces.append(html.escape(text[position : match.start()], quote=False))
+        pieces.append(tags[match.group(0)])
+        position = match.end()
+    pieces.append(html.escape(text[position:], quote=False))
+    return "".join(pieces)
+
+
+def translate_html(
+    html_string: str,
+    target_lang: str,
+    source_lang: Optional[str] = None,
+    report: Optional[dict] = None,
+    skip_tags=SKIP_TAGS,
+) -> str:
+    """Translate the text of an HTML document and keep its markup.
+
+    All text units are extracted in one pass and translated together with
+    `translate_texts`, so the number of upstream calls grows with the size
+    of the document rather than with the number of text nodes.
+
+    Args:
+        html_string: HTML document or fragment to translate
+        target_lang: The target language code (e.g., 'es' for Spanish)
+        source_lang: Optional source language code
+        report: Optional dictionary passed on to `translate_texts`
+        skip_tags: Elements whose contents are copied verbatim
+
+    Returns:
+        str: The translated HTML
+
+    Raises:
+        TranslationError: If the translation could not be completed
+    """
+    parser = _HtmlSegmenter(skip_tags)
+    parser.feed(html_string)
+    parser.close()
+    if not parser.units:
+        return "".join(parser.parts)
+
+    translations = translate_texts(
+        [source for source, _ in parser.units],
+        target_lang,
+        source_lang,
+        report=report,
+    )
+
+    return "".join(
+        (
+            _rebuild_unit(*parser.units[part], translations[part])
+            if isinstance(part, int)
+            else part
+        )
+        for part in parser.parts
+    )
+
+
 # ================================== #
 # Line transformation
 # ================================== #
 
 import cutlet
 import jaconv
+from collections import OrderedDict
+from threading import Lock, local
 from cutlet.cutlet import has_foreign_lemma
+from app.__exceptions import ExceptionList
 
 
 def is_kanji(char):
@@ -468,6 +862,107 @@ def is_kanji(char):
     return 0x4E00 <= ord(char) <= 0x9FFF
 
 
+class ReadingMemo:
+    """Bounded memo of per-word readings shared by every request.
+
+    Entries are keyed by (surface, pos1, kana) and hold the has-kanji flag,
+    the hiragana reading and, once requested, the romaji of the word. The
+    least recently used entry is evicted when `maxsize` is exceeded.
+    """
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def _entry(self, word) -> list:
+        key = (word.surface, word.feature.pos1, word.feature.kana)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        kana = word.feature.kana
+        entry = [
+            any(is_kanji(char) for char in word.surface),
+            jaconv.kata2hira(kana) if kana else None,
+            None,
+        ]
+        with self._lock:
+            self._entries[key] = entry
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def reading(self, word) -> tuple[bool, str | None]:
+        """Return (has_kanji, hiragana reading) for a tagged word."""
+        entry = self._entry(word)
+        return entry[0], entry[1]
+
+    def romaji(self, word, convert) -> str:
+        """Return the romaji of a tagged word, computing it with `convert` once."""
+        entry = self._entry(word)
+        if entry[2] is None:
+            entry[2] = convert(word)
+        return entry[2]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+reading_memo = ReadingMemo(int(os.getenv("READING_MEMO_SIZE", "100000")))
+
+
+class MemoCutlet(cutlet.Cutlet):
+    """Cutlet preloaded with the exception list that memoizes word romaji.
+
+    Every instance shares `reading_memo`, so they must all use the same
+    romanization settings and exceptions.
+    """
+
+    def __init__(self):
+        super().__init__()
+        for ex in ExceptionList:
+            self.add_exception(ex["from"], ex["to"])
+
+    def romaji_word(self, word):
+        return reading_memo.romaji(word, super().romaji_word)
+
+
+_thread_cutlets = local()
+
+
+def get_cutlet() -> MemoCutlet:
+    """Return this thread's MemoCutlet, creating its tagger on first use.
+
+    MeCab taggers are not safe to share between threads, but loading one per
+    request re-opens the dictionary every time, so each thread keeps its own.
+    """
+    katsu = getattr(_thread_cutlets, "katsu", None)
+    if katsu is None:
+        katsu = _thread_cutlets.katsu = MemoCutlet()
+    return katsu
+
+
+def preload():
+    """Load the tagger and dictionary and warm the code paths before forking."""
+    katsu = get_cutlet()
+    transform_line("日本語の文章を読み込みます。")
+    katsu.romaji("日本語の文章を読み込みます。")
+
+
 def transform_line(line: str):
     """Transform a Japanese sentence into structured data with original text and word-level furigana.
 
@@ -485,8 +980,7 @@ def transform_line(line: str):
             ]
         }
     """
-    katsu = cutlet.Cutlet()
-    words = katsu.tagger(line)
+    words = get_cutlet().tagger(line)
 
     result = {"origin": line, "translation": None, "words": []}
 
@@ -496,8 +990,7 @@ def transform_line(line: str):
         next_word = words[word_id + 1] if word_id < len(words) - 1 else None
 
         # Only provide furigana for words containing kanji
-        has_kanji = any(is_kanji(char) for char in word.surface)
-        furigana = jaconv.kata2hira(word.feature.kana) if word.feature.kana else None
+        has_kanji, furigana = reading_memo.reading(word)
 
         # Handle special cases that should have no furigana
         if (
@@ -587,3 +1080,124 @@ def transform_line(line: str):
         )
 
     return result
+
+
+# ================================== #
+# Tokenization
+# ================================== #
+
+
+def tokenize(text: str, with_particle: bool = True) -> str:
+    """Split Japanese text into space-separated surface tokens.
+
+    Spacing follows the same rules cutlet uses for romaji, so the tokens line
+    up with the words of `Cutlet.romaji`.
+
+    Args:
+        text: Japanese text to tokenize
+        with_particle: Keep particles in the output
+
+    Returns:
+        Tokens joined by single spaces
+    """
+    if not has_japanese(text):
+        return " ".join(text.split())
+
+    katsu = get_cutlet()
+    words = katsu.tagger(text)
+    out = []
+    # def cleaning_word(word):
+
+    for wi, word in enumerate(words):
+        po = out[-1] if out else None
+        pw = words[wi - 1] if wi > 0 else None
+        nw = words[wi + 1] if wi < len(words) - 1 else None
+        # handle possessive apostrophe as a special case
+        if (
+            word.surface == "'"
+            and (nw and nw.char_type == cutlet.CHAR_ALPHA and not nw.white_space)
+            and not word.white_space
+        ):
+            # remove preceeding space
+            if po:
+                po.space = False
+            out.append(cutlet.Token(word.surface, False))
+            continue
+
+        # ########
+        # if self.ensure_ascii:
+        #         out = '?' * len(word.surface)
+        #         return out
+        #     else:
+        #         return word.surface
+
+        if word.is_unk:
+            # print(word.surface)
+            roma = ""
+        elif word.feature.pos1 == "補助記号":
+            roma = ""
+        elif word.feature.pos1 == "助詞" and not with_particle:
+            roma = ""
+        else:
+            roma = word.surface
+        if roma and po and po.surface and po.surface[-1] == "っ":
+            po.surface = po.surface[:-1] + roma[0]
+        foreign = katsu.use_foreign_spelling and cutlet.has_foreign_lemma(word)
+        tok = cutlet.Token(roma, False, foreign)
+        # handle punctuation with atypical spacing
+        if word.surface in "「『":
+            if po:
+                po.space = True
+            out.append(tok)
+            continue
+        if roma in "([":
+            if po:
+                po.space = True
+            out.append(tok)
+            continue
+        if roma == "/":
+            out.append(tok)
+            continue
+
+        # preserve spaces between ascii tokens
+        if word.surface.isascii() and nw and nw.surface.isascii():
+            use_space = bool(nw.white_space)
+            out.append(cutlet.Token(word.surface, use_space))
+            continue
+
+        out.append(tok)
+        # no space sometimes
+        # お酒 -> osake
+        if word.feature.pos1 == "接頭辞":
+            continue
+        # 今日、 -> kyou, ; 図書館 -> toshokan
+        if nw and nw.feature.pos1 in ("補助記号", "接尾辞"):
+            continue
+        # special case for half-width commas
+        if nw and nw.surface == ",":
+            continue
+        # special case for prefixes
+        if foreign and roma[-1] == "-":
+            continue
+
+        # 思えば -> omoeba
+        if nw and nw.feature.pos2 in ("接続助詞"):
+            continue
+        # 333 -> 333 ; this should probably be handled in mecab
+        if word.surface.isdigit() and nw and nw.surface.isdigit():
+            continue
+        # そうでした -> sou deshita
+        if (
+            nw
+            and word.feature.pos1 in ("動詞", "助動詞", "形容詞")
+            and nw.feature.pos1 == "助動詞"
+            and nw.surface != "です"
+        ):
+            continue
+        # if we get here, it does need a space
+        tok.space = True
+
+    # remove any leftover っ
+    for tok in out:
+        tok.surface = tok.surface.replace("っ", "")
+    return "".join([str(tok) for tok in out]).strip()
@@ -0,0 +1,99 @@
+import re
+from bisect import bisect_right
+from itertools import accumulate
+
+from app._helpers import get_cutlet, transform_line
+
+# split after sentence terminators, keeping them with their sentence
+SENTENCE_BOUNDARY = re.compile(r"(?<=[。！？!?\n])")
+
+
+def split_sentences(text: str) -> list[str]:
+    return [sentence for sentence in SENTENCE_BOUNDARY.split(text) if sentence]
+
+
+def convert_sentence(sentence: str) -> dict:
+    """Romaji, furigana and token spans of one sentence.
+
+    Span offsets are relative to the sentence so they stay valid when text
+    before it is edited.
+    """
+    words = transform_line(sentence)["words"]
+    position = 0
+    for word in words:
+        start = sentence.find(word["text"], position)
+        if start == -1:
+            start = position
+        position = start + len(word["text"])
+        word["start"] = start
+        word["end"] = position
+    return {
+        "text": sentence,
+        "romaji": get_cutlet().romaji(sentence) if sentence.strip() else "",
+        "words": words,
+    }
+
+
+class LiveSession:
+    """Text buffer of one live-conversion connection.
+
+    The buffer is kept as a list of sentences with their conversions. An edit
+    only re-splits and re-converts the sentences it touches, so its cost
+    depends on the size of the edit and not on the length of the buffer.
+    """
+
+    def __init__(self, max_length: int | None = None):
+        self.max_length = max_length
+        self.sentences: list[str] = []
+        self.conversions: list[dict] = []
+
+    @property
+    def length(self) -> int:
+        return sum(len(sentence) for sentence in self.sentences)
+
+    def set(self, text: str) -> dict:
+        """Replace the whole buffer."""
+        return self.edit(0, self.length, text)
+
+    def edit(self, start: int, end: int, text: str) -> dict:
+        """Replace buffer[start:end] with `text` and convert what changed.
+
+        Returns an update replacing sentences `start`..`end` (exclusive) of the
+        previous buffer with `sentences`.
+        """
+        length = self.length
+        if not 0 <= start <= end <= length:
+            raise ValueError(f"Edit range {start}:{end} outside buffer of {length}")
+        if (
+            self.max_length is not None
+            and length - (end - start) + len(text) > self.max_length
+        ):
+            raise ValueError(f"Buffer longer than {self.max_length} characters")
+
+        offsets = [0, *accumulate(len(sentence) for sentence in self.sentences)]
+        # include the sentence before the edit, which text typed at its end joins
+        first = max(bisect_right(offsets, start) - 2, 0)
+        # and the sentence after it, which merges in if its boundary is edited
+        last = min(bisect_right(offsets, end), len(self.sentences))
+        local = "".join(self.sentences[first:last])
+        local_start = start - offsets[first]
+        local_end = end - offsets[first]
+        local = local[:local_start] + text + local[local_end:]
+
+        sentences = split_sentences(local)
+        # sentences at the edges of the window that did not change keep their
+        # conversion
+        old = dict(zip(self.sentences[first:last], self.conversions[first:last]))
+        conversions = [
+            old.get(sentence) or convert_sentence(sentence) for sentence in sentences
+        ]
+
+        self.sentences[first:last] = sentences
+        self.conversions[first:last] = conversions
+        return {
+            "type": "update",
+            "start": first,
+            "end": last,
+            "sentences": conversions,
+            "count": len(self.sentences),
+        }
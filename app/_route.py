@@ -1,20 +1,60 @@
-import cutlet
-from fastapi import APIRouter, Request, HTTPException
-
-from cutlet import Cutlet
+import logging
+import math
+import os
+
+from fastapi import (
+    APIRouter,
+    HTTPException,
+    Query,
+    Request,
+    WebSocket,
+)
+from fastapi.responses import StreamingResponse
 
-from app.__exceptions import ExceptionList
 from app._helpers import (
+    TRANSLATION_MODEL,
     fetch_news,
+    furigana_markup,
+    get_cutlet,
+    has_japanese,
     request_allowed,
     process_html,
-    transform_line,
+    reading_memo,
+    romaji_markup,
+    tokenize,
+    TranslationError,
     translate_array,
+    translate_html,
     translate_text,
 )
-from app.rate_limiter import authenticated, limiter, get_rate_limit
-from app._info import __version__
+from app.rate_limiter import authenticated, get_key, limiter, get_rate_limit
+from app._budget import TokenBucket, admission, estimate_cost
+from app._singleflight import translations
+from app._executors import cpu_executor, io_executor
+from app._encoding import FastJSONResponse, columnar_line, token_offsets
+from app._cache import cached_response, make_etag
+from app._live import LiveSession
+from app._translation_memory import translation_memory
+from app._documents import (
+    Document,
+    apply_edits,
+    document_index,
+    iter_batches,
+    iter_lines,
+    transform_lines,
+)
+from app._server import memory_usage
+from app._info import __token__, __version__
 from pydantic import BaseModel, Field
+import orjson
+
+logger = logging.getLogger(__name__)
+
+FREE_LIVE_LENGTH = 350
+# messages an unauthenticated /live connection may send per minute
+FREE_LIVE_MESSAGES = int(os.getenv("LIVE_FREE_MESSAGES_PER_MINUTE", "30"))
+# characters of input processed per chunk of a streamed response
+STREAM_BATCH_CHARS = int(os.getenv("STREAM_BATCH_CHARS", "2000"))
 
 
 class RomajiRequest(BaseModel):
@@ -26,9 +66,20 @@ class SlugRequest(BaseModel):
     str: str
 
 
+class LineEdit(BaseModel):
+    start: int
+    end: int
+    lines: list[str] = []
+
+
 class TransformRequest(BaseModel):
-    text: str
+    text: str = ""
     target: str = "en"
+    compact: bool = False
+    document_id: str | None = None
+    edits: list[LineEdit] | None = None
+    translate: bool = True
+    stream: bool = False
 
 
 class TransformNewsRequest(BaseModel):
@@ -48,207 +99,269 @@ class TranslateBatchRequest(BaseModel):
     source_lang: str | None = None
 
 
+class TranslateHtmlRequest(BaseModel):
+    html: str
+    target_lang: str = "en"
+    source_lang: str | None = None
+
+
 class TokenizerRequest(BaseModel):
     str: str
     with_particle: bool = True
+    compact: bool = False
+    stream: bool = False
 
 
 router = APIRouter()
 
 
+def _ndjson(records) -> bytes:
+    return b"".join(orjson.dumps(record) + b"\n" for record in records)
+
+
+def _stream_response(batches, executor, process) -> StreamingResponse:
+    """Stream the NDJSON chunks of `process(batch)` for every batch in order.
+
+    Each batch runs on `executor` only once the previous chunk has been sent,
+    so no more than one batch of results is held at a time. An error raised
+    after the response has started is sent as a final {"error": ...} record.
+    """
+
+    async def chunks():
+        try:
+            for batch in batches:
+                yield await executor.run(process, batch)
+        except HTTPException as e:
+            yield _ndjson([{"error": e.detail}])
+        except Exception:
+            logger.exception("Streamed response failed")
+            yield _ndjson([{"error": "Internal server error."}])
+
+    return StreamingResponse(chunks(), media_type="application/x-ndjson")
+
+
 @limiter.limit(get_rate_limit)
 @router.get("/")
 async def home(request: Request):
     return {"version": __version__}
 
 
+@limiter.limit(get_rate_limit)
+@router.get("/stats")
+def stats(request: Request):
+    auth = authenticated(request)
+    if not auth:
+        raise HTTPException(
+            status_code=401, detail="Only authenticated users can access this endpoint."
+        )
+    return {
+        "auth": auth,
+        "reading_memo": reading_memo.stats(),
+        "document_index": document_index.stats(),
+        "translation_memory": translation_memory.stats(),
+        "token_budget": admission.stats(),
+        "coalescing": translations.stats(),
+        "executors": {"cpu": cpu_executor.stats(), "upstream": io_executor.stats()},
+        "worker": memory_usage(),
+    }
+
+
 @limiter.limit(get_rate_limit)
 @router.post("/romaji")
-def romaji(request: Request, validated_request: RomajiRequest):
+async def romaji(request: Request, validated_request: RomajiRequest):
+    return await cpu_executor.run(_romaji, request, validated_request)
+
+
+def _romaji(request: Request, validated_request: RomajiRequest):
     auth = authenticated(request)
-    if not request_allowed(request):
+    if not request_allowed(request, validated_request.str):
         raise HTTPException(
             status_code=422,
             detail="Not authenticated or allowed string length exceeded.",
         )
 
-    translator = Cutlet()
-    for ex in ExceptionList:
-        translator.add_exception(ex["from"], ex["to"])
-    if validated_request.html:
-        try:
-            translated_html = process_html(
-                validated_request.str, lambda x: translator.romaji(x)
-            )
+    def compute():
+        translator = get_cutlet()
+        if validated_request.html:
+            try:
+                translated_html = process_html(
+                    validated_request.str, romaji_markup(translator)
+                )
+
+                return {"auth": auth, "result": translated_html}
+            except Exception:
+                raise HTTPException(
+                    status_code=422, detail="HTML not clean and can't be processed."
+                )
+        elif not has_japanese(validated_request.str):
+            return {"auth": auth, "result": validated_request.str}
+        else:
+            return {"auth": auth, "result": translator.romaji(validated_request.str)}
 
-            return {"auth": auth, "result": translated_html}
-        except Exception:
-            raise HTTPException(
-                status_code=422, detail="HTML not clean and can't be processed."
-            )
-    else:
-        return {"auth": auth, "result": translator.romaji(validated_request.str)}
+    etag = make_etag("romaji", auth, validated_request.str, validated_request.html)
+    return cached_response(request, etag, compute)
+
+
+@limiter.limit(get_rate_limit)
+@router.get("/romaji")
+async def romaji_get(
+    request: Request, text: str = Query(alias="str"), html: bool = False
+):
+    return await cpu_executor.run(_romaji, request, RomajiRequest(str=text, html=html))
 
 
 @limiter.limit(get_rate_limit)
 @router.post("/furigana")
-def furigana(request: Request, validated_request: RomajiRequest):
+async def furigana(request: Request, validated_request: RomajiRequest):
+    return await cpu_executor.run(_furigana, request, validated_request)
+
+
+def _furigana(request: Request, validated_request: RomajiRequest):
     auth = authenticated(request)
-    if not request_allowed(request):
+    if not request_allowed(request, validated_request.str):
         raise HTTPException(
             status_code=422,
             detail="Not authenticated or allowed string length exceeded.",
         )
+    if not validated_request.html:
+        raise HTTPException(status_code=400, detail="html params must be true")
 
-    translator = Cutlet()
-    for ex in ExceptionList:
-        translator.add_exception(ex["from"], ex["to"])
-    if validated_request.html:
+    def compute():
+        translator = get_cutlet()
         try:
             translated_html = process_html(
-                validated_request.str,
-                lambda x: f"<ruby>{x}<rt>{translator.romaji(x)}<rt></ruby>",
+                validated_request.str, furigana_markup(translator)
             )
             return {"auth": auth, "result": translated_html}
         except Exception:
             raise HTTPException(
                 status_code=422, detail="HTML not clean and can't be processed."
             )
-    else:
-        raise HTTPException(status_code=400, detail="html params must be true")
+
+    etag = make_etag("furigana", auth, validated_request.str)
+    return cached_response(request, etag, compute)
+
+
+@limiter.limit(get_rate_limit)
+@router.get("/furigana")
+async def furigana_get(
+    request: Request, text: str = Query(alias="str"), html: bool = True
+):
+    return await cpu_executor.run(
+        _furigana, request, RomajiRequest(str=text, html=html)
+    )
 
 
 @limiter.limit(get_rate_limit)
 @router.post("/slug")
-def slug(request: Request, validated_request: SlugRequest):
+async def slug(request: Request, validated_request: SlugRequest):
+    return await cpu_executor.run(_slug, request, validated_request)
+
+
+def _slug(request: Request, validated_request: SlugRequest):
     auth = authenticated(request)
-    if not request_allowed(request):
+    if not request_allowed(request, validated_request.str):
         raise HTTPException(
             status_code=422,
             detail="Not authenticated or allowed string length exceeded.",
         )
-    translator = Cutlet()
+    etag = make_etag("slug", auth, validated_request.str)
+    return cached_response(
+        request,
+        etag,
+        lambda: {"auth": auth, "result": get_cutlet().slug(validated_request.str)},
+    )
 
-    for ex in ExceptionList:
-        translator.add_exception(ex["from"], ex["to"])
-    return {"auth": auth, "result": translator.slug(validated_request.str)}
+
+@limiter.limit(get_rate_limit)
+@router.get("/slug")
+async def slug_get(request: Request, text: str = Query(alias="str")):
+    return await cpu_executor.run(_slug, request, SlugRequest(str=text))
 
 
 @limiter.limit(get_rate_limit)
 @router.post("/tokenizer")
-def tokenizer(request: Request, validated_request: TokenizerRequest):
-    auth = authenticated(request)
-    if not request_allowed(request):
+async def tokenizer(request: Request, validated_request: TokenizerRequest):
+    if validated_request.stream:
+        return _stream_tokenizer(request, validated_request)
+    return await cpu_executor.run(_tokenizer, request, validated_request)
+
+
+def _stream_tokenizer(request: Request, validated_request: TokenizerRequest):
+    if not request_allowed(request, validated_request.str):
         raise HTTPException(
             status_code=422,
             detail="Not authenticated or allowed string length exceeded.",
         )
-    words = Cutlet().tagger(validated_request.str)
-    out = []
-    # def cleaning_word(word):
-
-    for wi, word in enumerate(words):
-        po = out[-1] if out else None
-        pw = words[wi - 1] if wi > 0 else None
-        nw = words[wi + 1] if wi < len(words) - 1 else None
-        # handle possessive apostrophe as a special case
-        if (
-            word.surface == "'"
-            and (nw and nw.char_type == cutlet.CHAR_ALPHA and not nw.white_space)
-            and not word.white_space
-        ):
-            # remove preceeding space
-            if po:
-                po.space = False
-            out.append(cutlet.Token(word.surface, False))
-            continue
 
-        # ########
-        # if self.ensure_ascii:
-        #         out = '?' * len(word.surface)
-        #         return out
-        #     else:
-        #         return word.surface
-
-        if word.is_unk:
-            # print(word.surface)
-            roma = ""
-        elif word.feature.pos1 == "補助記号":
-            roma = ""
-        elif word.feature.pos1 == "助詞" and not validated_request.with_particle:
-            roma = ""
-        else:
-            roma = word.surface
-        if roma and po and po.surface and po.surface[-1] == "っ":
-            po.surface = po.surface[:-1] + roma[0]
-        foreign = Cutlet().use_foreign_spelling and cutlet.has_foreign_lemma(word)
-        tok = cutlet.Token(roma, False, foreign)
-        # handle punctuation with atypical spacing
-        if word.surface in "「『":
-            if po:
-                po.space = True
-            out.append(tok)
-            continue
-        if roma in "([":
-            if po:
-                po.space = True
-            out.append(tok)
-            continue
-        if roma == "/":
-            out.append(tok)
-            continue
+    def process(batch: list[str]) -> bytes:
+        records = []
+        for line in batch:
+            strr = tokenize(line, validated_request.with_particle)
+            if validated_request.compact:
+                records.append({"text": strr, "offsets": token_offsets(strr)})
+            else:
+                records.append(strr.split(" "))
+        return _ndjson(records)
 
-        # preserve spaces between ascii tokens
-        if word.surface.isascii() and nw and nw.surface.isascii():
-            use_space = bool(nw.white_space)
-            out.append(cutlet.Token(word.surface, use_space))
-            continue
+    return _stream_response(
+        iter_batches(iter_lines(validated_request.str), STREAM_BATCH_CHARS),
+        cpu_executor,
+        process,
+    )
 
-        out.append(tok)
-        # no space sometimes
-        # お酒 -> osake
-        if word.feature.pos1 == "接頭辞":
-            continue
-        # 今日、 -> kyou, ; 図書館 -> toshokan
-        if nw and nw.feature.pos1 in ("補助記号", "接尾辞"):
-            continue
-        # special case for half-width commas
-        if nw and nw.surface == ",":
-            continue
-        # special case for prefixes
-        if foreign and roma[-1] == "-":
-            continue
 
-        # 思えば -> omoeba
-        if nw and nw.feature.pos2 in ("接続助詞"):
-            continue
-        # 333 -> 333 ; this should probably be handled in mecab
-        if word.surface.isdigit() and nw and nw.surface.isdigit():
-            continue
-        # そうでした -> sou deshita
-        if (
-            nw
-            and word.feature.pos1 in ("動詞", "助動詞", "形容詞")
-            and nw.feature.pos1 == "助動詞"
-            and nw.surface != "です"
-        ):
-            continue
-        # if we get here, it does need a space
-        tok.space = True
+def _tokenizer(request: Request, validated_request: TokenizerRequest):
+    auth = authenticated(request)
+    if not request_allowed(request, validated_request.str):
+        raise HTTPException(
+            status_code=422,
+            detail="Not authenticated or allowed string length exceeded.",
+        )
 
-    # remove any leftover っ
-    for tok in out:
-        tok.surface = tok.surface.replace("っ", "")
-    # strr = [str(tok) for tok in out]
-    strr = "".join([str(tok) for tok in out]).strip()
-    return {"auth": auth, "result": strr.split(" ")}
+    def compute():
+        strr = tokenize(validated_request.str, validated_request.with_particle)
+        if validated_request.compact:
+            return {
+                "auth": auth,
+                "result": {"text": strr, "offsets": token_offsets(strr)},
+            }
+        return {"auth": auth, "result": strr.split(" ")}
+
+    etag = make_etag(
+        "tokenizer",
+        auth,
+        validated_request.str,
+        validated_request.with_particle,
+        validated_request.compact,
+    )
+    return cached_response(request, etag, compute)
+
+
+@limiter.limit(get_rate_limit)
+@router.get("/tokenizer")
+async def tokenizer_get(
+    request: Request,
+    text: str = Query(alias="str"),
+    with_particle: bool = True,
+    compact: bool = False,
+):
+    return await cpu_executor.run(
+        _tokenizer,
+        request,
+        TokenizerRequest(str=text, with_particle=with_particle, compact=compact),
+    )
 
 
 @limiter.limit(get_rate_limit)
 @router.get("/get-news")
-def get_news(
+async def get_news(
     request: Request, target: str = "en", category: str = "science", number: int = 10
 ):
+    return await io_executor.run(_get_news, request, target, category, number)
+
+
+def _get_news(request: Request, target: str, category: str, number: int):
     auth = authenticated(request)
     if not auth:
         raise HTTPException(
@@ -285,61 +398,295 @@ def get_news(
 
 @limiter.limit(get_rate_limit)
 @router.post("/transform-text")
-def transform_text(request: Request, validated_request: TransformRequest):
+async def transform_text(request: Request, validated_request: TransformRequest):
+    if validated_request.stream:
+        return _stream_transform_text(request, validated_request)
+    return await _transform_executor(validated_request).run(
+        _transform_text, request, validated_request
+    )
+
+
+def _transform_executor(validated_request: TransformRequest):
+    # tag-only transforms never wait on the model
+    return io_executor if validated_request.translate else cpu_executor
+
+
+def _stream_transform_text(request: Request, validated_request: TransformRequest):
+    auth = authenticated(request)
+    if not auth:
+        raise HTTPException(
+            status_code=401, detail="Only authenticated user can access this endpoint."
+        )
+    if validated_request.document_id or validated_request.edits is not None:
+        raise HTTPException(
+            status_code=422, detail="Streaming does not support document_id or edits."
+        )
+
+    key = get_key(request)
+
+    def process(batch: list[str]) -> bytes:
+        lines, _, _ = transform_lines(
+            batch,
+            validated_request.target,
+            admit=lambda texts: admission.admit(key, estimate_cost(texts)),
+            translate=validated_request.translate,
+        )
+        if validated_request.compact:
+            lines = [columnar_line(line) for line in lines]
+        return _ndjson(lines)
+
+    return _stream_response(
+        iter_batches(iter_lines(validated_request.text), STREAM_BATCH_CHARS),
+        _transform_executor(validated_request),
+        process,
+    )
+
+
+def _transform_text(request: Request, validated_request: TransformRequest):
     auth = authenticated(request)
     if not auth:
         raise HTTPException(
             status_code=401, detail="Only authenticated user can access this endpoint."
         )
 
-    splitted_content = [
-        line for line in validated_request.text.split("\n") if line != ""
-    ]
-    translated_content = translate_array(splitted_content, validated_request.target)
-    transformed_line = [transform_line(line) for line in splitted_content]
-    if len(transformed_line) == len(translated_content):
-        for i in range(len(transformed_line)):
-            transformed_line[i]["translation"] = str(translated_content[i])
-    elif len(transformed_line) == 1:
-        transformed_line[0]["translation"] = str(translated_content[0])
+    document_id = validated_request.document_id
+    document = document_index.get(document_id) if document_id else None
+    if validated_request.edits is not None:
+        if document is None:
+            raise HTTPException(
+                status_code=404, detail="Unknown document, submit the full text first."
+            )
+        try:
+            splitted_content = apply_edits(document.lines, validated_request.edits)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    else:
+        splitted_content = [
+            line for line in validated_request.text.split("\n") if line != ""
+        ]
+
+    key = get_key(request)
+
+    def work():
+        return transform_lines(
+            splitted_content,
+            validated_request.target,
+            document.results if document else None,
+            admit=lambda texts: admission.admit(key, estimate_cost(texts)),
+            translate=validated_request.translate,
+        )
+
+    if document_id:
+        # documents carry per-client state and are never shared
+        transformed_line, results, reused = work()
+    else:
+        (transformed_line, results, reused), _ = translations.do(
+            (
+                "transform",
+                validated_request.text,
+                validated_request.target,
+                validated_request.translate,
+                TRANSLATION_MODEL,
+            ),
+            work,
+        )
+    if document_id:
+        document_index.put(document_id, Document(splitted_content, results))
 
-    return {"auth": auth, "result": transformed_line}
+    if validated_request.compact:
+        transformed_line = [columnar_line(line) for line in transformed_line]
+    response = {"auth": auth, "result": transformed_line}
+    if document_id:
+        response["reused"] = reused
+    return FastJSONResponse(response)
 
 
 @limiter.limit(get_rate_limit)
 @router.post("/translate-text")
-def translate(request: Request, validated_request: TranslateTextRequest):
+async def translate(request: Request, validated_request: TranslateTextRequest):
+    return await io_executor.run(_translate, request, validated_request)
+
+
+def _translate(request: Request, validated_request: TranslateTextRequest):
     auth = authenticated(request)
     if not auth:
         raise HTTPException(
             status_code=401, detail="Only authenticated users can access this endpoint."
         )
-    return {
-        "auth": auth,
-        "result": translate_text(
+
+    def work():
+        with admission.admit(
+            get_key(request), estimate_cost([validated_request.text])
+        ) as report:
+            result = translate_text(
+                validated_request.text,
+                validated_request.target_lang,
+                validated_request.source_lang,
+                report=report,
+            )
+        return result, report
+
+    (result, report), shared = translations.do(
+        (
+            "text",
             validated_request.text,
             validated_request.target_lang,
             validated_request.source_lang,
+            TRANSLATION_MODEL,
         ),
-    }
+        work,
+    )
+    if shared:
+        report = {"coalesced": True}
+    return {"auth": auth, "result": result, "usage": report}
 
 
 @limiter.limit(get_rate_limit)
 @router.post("/translate-batch")
-def translate_batch(
-    request: Request,
-    validated_request: TranslateBatchRequest,
+async def translate_batch(request: Request, validated_request: TranslateBatchRequest):
+    return await io_executor.run(_translate_batch, request, validated_request)
+
+
+def _translate_batch(request: Request, validated_request: TranslateBatchRequest):
+    auth = authenticated(request)
+    if not auth:
+        raise HTTPException(
+            status_code=401, detail="Only authenticated users can access this endpoint."
+        )
+
+    def work():
+        with admission.admit(
+            get_key(request), estimate_cost(validated_request.texts)
+        ) as report:
+            results = translate_array(
+                validated_request.texts,
+                validated_request.target_lang,
+                validated_request.source_lang,
+                report=report,
+            )
+        return results, report
+
+    (results, report), shared = translations.do(
+        (
+            "batch",
+            tuple(validated_request.texts),
+            validated_request.target_lang,
+            validated_request.source_lang,
+            TRANSLATION_MODEL,
+        ),
+        work,
+    )
+    if shared:
+        report = {"coalesced": True}
+    return {"auth": auth, "results": results, "usage": report}
+
+
+@limiter.limit(get_rate_limit)
+@router.post("/translate-html")
+async def translate_html_route(
+    request: Request, validated_request: TranslateHtmlRequest
 ):
+    return await io_executor.run(_translate_html, request, validated_request)
+
+
+def _translate_html(request: Request, validated_request: TranslateHtmlRequest):
     auth = authenticated(request)
     if not auth:
         raise HTTPException(
             status_code=401, detail="Only authenticated users can access this endpoint."
         )
-    return {
-        "auth": auth,
-        "results": translate_array(
-            validated_request.texts,
+
+    def work():
+        with admission.admit(
+            get_key(request), estimate_cost([validated_request.html])
+        ) as report:
+            try:
+                result = translate_html(
+                    validated_request.html,
+                    validated_request.target_lang,
+                    validated_request.source_lang,
+                    report=report,
+                )
+            except TranslationError as e:
+                raise HTTPException(status_code=502, detail=str(e))
+            except Exception:
+                raise HTTPException(
+                    status_code=422, detail="HTML not clean and can't be processed."
+                )
+        return result, report
+
+    (result, report), shared = translations.do(
+        (
+            "html",
+            validated_request.html,
             validated_request.target_lang,
             validated_request.source_lang,
+            TRANSLATION_MODEL,
         ),
-    }
+        work,
+    )
+    if shared:
+        report = {"coalesced": True}
+    return {"auth": auth, "result": result, "usage": report}
+
+
+@router.websocket("/live")
+async def live(websocket: WebSocket):
+    """Live romaji/furigana conversion of a text buffer edited over a WebSocket.
+
+    Clients send {"op": "set", "text": ...} or
+    {"op": "edit", "start": int, "end": int, "text": ...} and receive the
+    re-converted sentences around each edit.
+    """
+    auth = authenticated(websocket) or websocket.query_params.get("token") == __token__
+    await websocket.accept()
+    session = LiveSession(None if auth else FREE_LIVE_LENGTH)
+    bucket = None if auth else TokenBucket(FREE_LIVE_MESSAGES / 60, FREE_LIVE_MESSAGES)
+    while True:
+        frame = await websocket.receive()
+        if frame["type"] == "websocket.disconnect":
+            return
+        try:
+            # binary frames carry no "text" and are rejected like bad JSON
+            message = orjson.loads(frame["text"]) if frame.get("text") else None
+        except orjson.JSONDecodeError:
+            message = None
+        if bucket is not None:
+            wait = bucket.wait_time(1)
+            if wait:
+                await websocket.send_json(
+                    {
+                        "type": "error",
+                        "detail": "Rate limit exceeded.",
+                        "retry_after": math.ceil(wait),
+                    }
+                )
+                continue
+            bucket.take(1)
+        if not isinstance(message, dict):
+            await websocket.send_json(
+                {
+                    "type": "error",
+                    "detail": "Messages must be JSON objects in text frames.",
+                }
+            )
+            continue
+        try:
+            if message.get("op") == "set":
+                update = await cpu_executor.run(session.set, str(message["text"]))
+            elif message.get("op") == "edit":
+                update = await cpu_executor.run(
+                    session.edit,
+                    int(message["start"]),
+                    int(message["end"]),
+                    str(message.get("text", "")),
+                )
+            else:
+                raise ValueError("op must be set or edit")
+        except (KeyError, TypeError, ValueError) as e:
+            await websocket.send_json({"type": "error", "detail": str(e)})
+            continue
+        except HTTPException as e:
+            await websocket.send_json({"type": "error", "detail": e.detail})
+            continue
+        await websocket.send_text(orjson.dumps(update).decode())
@@ -0,0 +1,148 @@
+import gc
+import os
+import resource
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import uvicorn
+
+from app._helpers import preload
+
+# a worker exiting sooner than this after its start counts as a crash
+RESPAWN_WINDOW = float(os.getenv("WORKER_RESPAWN_WINDOW", "10"))
+# consecutive crashes after which the server gives up
+MAX_RESPAWNS = int(os.getenv("WORKER_MAX_RESPAWNS", "5"))
+
+MEMORY_FIELDS = {
+    "Rss": "rss_kb",
+    "Pss": "pss_kb",
+    "Shared_Clean": "shared_clean_kb",
+    "Shared_Dirty": "shared_dirty_kb",
+    "Private_Clean": "private_clean_kb",
+    "Private_Dirty": "private_dirty_kb",
+}
+
+
+def memory_usage() -> dict:
+    """Report the memory of the current worker process in kilobytes.
+
+    Pss splits shared pages between the processes mapping them, so the sum of
+    Pss over all workers is the real footprint of the container.
+    """
+    usage = {"pid": os.getpid()}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in MEMORY_FIELDS:
+                    usage[MEMORY_FIELDS[name]] = int(value.split()[0])
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux
+        usage["rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage
+
+
+def _bind(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _spawn(app, sock: socket.socket, **config) -> int:
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        code = 0
+        try:
+            uvicorn.Server(uvicorn.Config(app, **config)).run(sockets=[sock])
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            # never return into the parent's code
+            os._exit(code)
+    return pid
+
+
+def serve(app, host: str = "0.0.0.0", port: int = 3097, workers: int = 1, **config):
+    """Run the app with uvicorn, forking `workers` processes when above one.
+
+    Imported modules and the warmed reading memo are loaded once in the
+    parent and frozen out of the garbage collector before forking, so the
+    workers share those pages copy-on-write. Taggers are per thread and
+    requests run on executor threads, so each worker still builds its own
+    taggers; MeCab maps the dictionary files read-only, which keeps their
+    pages shared through the page cache.
+
+    Workers that die are replaced until the parent receives SIGINT or
+    SIGTERM. A worker exiting within `RESPAWN_WINDOW` seconds is respawned
+    after an exponential backoff, and after `MAX_RESPAWNS` such crashes in a
+    row the server stops.
+    """
+    preload()
+    if workers <= 1:
+        uvicorn.run(app, host=host, port=port, **config)
+        return
+
+    sock = _bind(host, port)
+    gc.collect()
+    gc.freeze()
+
+    # pid -> start time
+    children = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for _ in range(workers):
+        children[_spawn(app, sock, **config)] = time.monotonic()
+
+    crashes = 0
+    failed = False
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = children.pop(pid, None)
+        if stopping:
+            continue
+        if started is not None and time.monotonic() - started < RESPAWN_WINDOW:
+            crashes += 1
+        else:
+            crashes = 0
+        if crashes > MAX_RESPAWNS:
+            print(
+                f"Worker crashed {crashes} times in a row, stopping.", file=sys.stderr
+            )
+            failed = True
+            stop(None, None)
+            continue
+        if crashes:
+            time.sleep(min(2 ** (crashes - 1), 30))
+        if not stopping:
+            children[_spawn(app, sock, **config)] = time.monotonic()
+    sock.close()
+    if failed:
+        sys.exit(1)
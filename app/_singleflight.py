@@ -0,0 +1,65 @@
+from threading import Event, Lock
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one execution.
+
+    The first caller of a key runs the function; callers arriving while it is
+    still running wait for it and receive the same result. If the leading call
+    fails, each waiting caller retries on its own instead of inheriting an
+    error that may be specific to the leader (such as its exhausted budget).
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._calls: dict = {}
+        self._lock = Lock()
+
+    def do(self, key, fn) -> tuple:
+        """Run `fn` once for all concurrent callers of `key`.
+
+        Returns:
+            (result of `fn`, whether it was shared from another caller)
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                if call is None:
+                    call = self._calls[key] = _Call()
+                    self.calls += 1
+                    break
+                self.coalesced += 1
+            call.done.wait()
+            if call.error is None:
+                return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls),
+        }
+
+
+translations = SingleFlight()
@@ -0,0 +1,193 @@
+import os
+import random
+from difflib import SequenceMatcher
+from collections import OrderedDict
+from threading import Lock
+from typing import NamedTuple
+
+# Mersenne prime used by the MinHash permutations
+_PRIME = (1 << 61) - 1
+
+
+class Match(NamedTuple):
+    similarity: float
+    source: str
+    translation: str
+    # whether the translation can be reused without asking the model
+    direct: bool = False
+
+
+def shingles(text: str, size: int = 3) -> frozenset[str]:
+    """Character n-grams of `text` with whitespace collapsed."""
+    text = " ".join(text.split())
+    if len(text) <= size:
+        return frozenset([text]) if text else frozenset()
+    return frozenset(text[i : i + size] for i in range(len(text) - size + 1))
+
+
+def differs_in_numbers(a: str, b: str) -> bool:
+    """Check whether the characters that differ between `a` and `b` include numerals."""
+    for tag, i1, i2, j1, j2 in SequenceMatcher(
+        None, a, b, autojunk=False
+    ).get_opcodes():
+        if tag != "equal" and any(char.isnumeric() for char in a[i1:i2] + b[j1:j2]):
+            return True
+    return False
+
+
+class TranslationMemory:
+    """Bounded memory of past translations searchable by similarity.
+
+    Sources are indexed by MinHash signatures of their character trigrams,
+    split into LSH bands so that a lookup only compares against sources that
+    share at least one band. Candidates are ranked by their exact Jaccard
+    similarity. Only exact repeats are reused directly by default; with a
+    `direct_threshold` below 1.0 a near match is too, unless the characters
+    that differ include numerals (a boilerplate line with another date).
+
+    Sources longer than `max_source_length` are not remembered. The least
+    recently used entries are evicted once `max_entries` or `max_shingles`,
+    the trigrams held over all entries, is exceeded.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 50000,
+        direct_threshold: float = 1.0,
+        reference_threshold: float = 0.6,
+        bands: int = 16,
+        rows: int = 2,
+        max_source_length: int = 2000,
+        max_shingles: int = 2000000,
+    ):
+        self.max_entries = max_entries
+        self.max_source_length = max_source_length
+        self.max_shingles = max_shingles
+        self._shingles = 0
+        self.direct_threshold = direct_threshold
+        self.reference_threshold = reference_threshold
+        self.bands = bands
+        self.rows = rows
+        generator = random.Random(0)
+        self._permutations = [
+            (generator.randrange(1, _PRIME), generator.randrange(0, _PRIME))
+            for _ in range(bands * rows)
+        ]
+        # (target, source) -> (translation, shingles, band keys)
+        self._entries = OrderedDict()
+        self._buckets: dict[tuple, set] = {}
+        self._lock = Lock()
+        self.direct_hits = 0
+        self.reference_hits = 0
+        self.misses = 0
+
+    def _band_keys(self, target: str, grams: frozenset[str]) -> list[tuple]:
+        hashes = [hash(gram) & 0xFFFFFFFFFFFFFFFF for gram in grams]
+        signature = [
+            min((a * h + b) % _PRIME for h in hashes) for a, b in self._permutations
+        ]
+        return [
+            (target, band, tuple(signature[band * self.rows : (band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    def add(self, source: str, target: str, translation: str):
+        if len(source) > self.max_source_length:
+            return
+        grams = shingles(source)
+        if not grams:
+            return
+        key = (target, source)
+        band_keys = self._band_keys(target, grams)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (translation, grams, band_keys)
+            self._shingles += len(grams)
+            for band_key in band_keys:
+                self._buckets.setdefault(band_key, set()).add(key)
+            while (
+                len(self._entries) > self.max_entries
+                or self._shingles > self.max_shingles
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: tuple):
+        _, grams, band_keys = self._entries.pop(key)
+        self._shingles -= len(grams)
+        for band_key in band_keys:
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def lookup(self, source: str, target: str) -> Match | None:
+        """Return the most similar remembered translation, if any is similar enough.
+
+        Exact repeats are found without hashing. The match is counted as a
+        direct or reference hit depending on `Match.direct`.
+        """
+        key = (target, source)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.direct_hits += 1
+                return Match(1.0, source, entry[0], True)
+
+        if len(source) > self.max_source_length:
+            with self._lock:
+                self.misses += 1
+            return None
+        grams = shingles(source)
+        if not grams:
+            return None
+        band_keys = self._band_keys(target, grams)
+        best = None
+        with self._lock:
+            candidates = set()
+            for band_key in band_keys:
+                candidates.update(self._buckets.get(band_key, ()))
+            for candidate in candidates:
+                translation, other, _ = self._entries[candidate]
+                similarity = len(grams & other) / len(grams | other)
+                if best is None or similarity > best.similarity:
+                    best = Match(similarity, candidate[1], translation)
+
+            if best is None or best.similarity < self.reference_threshold:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((target, best.source))
+
+        direct = best.similarity >= self.direct_threshold and not differs_in_numbers(
+            source, best.source
+        )
+        with self._lock:
+            if direct:
+                self.direct_hits += 1
+            else:
+                self.reference_hits += 1
+        return best._replace(direct=direct)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "shingles": self._shingles,
+            "max_shingles": self.max_shingles,
+            "direct_threshold": self.direct_threshold,
+            "reference_threshold": self.reference_threshold,
+            "direct_hits": self.direct_hits,
+            "reference_hits": self.reference_hits,
+            "misses": self.misses,
+        }
+
+
+translation_memory = TranslationMemory(
+    max_entries=int(os.getenv("TM_MAX_ENTRIES", "50000")),
+    direct_threshold=float(os.getenv("TM_DIRECT_THRESHOLD", "1.0")),
+    reference_threshold=float(os.getenv("TM_REFERENCE_THRESHOLD", "0.6")),
+    max_source_length=int(os.getenv("TM_MAX_SOURCE_LENGTH", "2000")),
+    max_shingles=int(os.getenv("TM_MAX_SHINGLES", "2000000")),
+)
@@ -0,0 +1,296 @@
+"""Offline bulk processing of text archives without going through the HTTP API.
+
+Usage:
+    python -m app.cli romaji novel.txt -o novel.romaji.jsonl
+    python -m app.cli translate requests.jsonl --field body -o out.jsonl --target en
+
+Input files are read lazily. Plain text files yield one record per line,
+JSONL files one record per line (taking `--field` from each object) and
+HTML files one record per file, because markup may span lines. Records are
+processed in batches by a pool of worker processes and written to the output
+as JSONL, one line per record, in input order. Re-running the same command
+resumes after the last record already present in the output file;
+with --retry-errors, records written with an error are processed again.
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orjson
+
+from app._helpers import (
+    TranslationError,
+    furigana_markup,
+    get_cutlet,
+    preload,
+    process_html,
+    romaji_markup,
+    transform_line,
+    translate_texts,
+)
+
+MODES = ("romaji", "furigana", "transform", "translate")
+
+_katsu = None
+
+
+def _init_worker():
+    global _katsu
+    _katsu = get_cutlet()
+
+
+def detect_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if extension in (".html", ".htm", ".xhtml"):
+        return "html"
+    return "text"
+
+
+def parse_jsonl_record(line: str, field: str) -> tuple[str, str | None]:
+    """Return (text, error) for one JSONL line; bad lines become error records."""
+    try:
+        record = orjson.loads(line)
+    except orjson.JSONDecodeError as e:
+        return "", f"Invalid JSON: {e}"
+    if not isinstance(record, dict):
+        return "", "Record is not a JSON object"
+    return str(record.get(field) or ""), None
+
+
+def read_records(paths: list[str], input_format: str, field: str):
+    """Yield (source, text, is_html, error) for every record of the input files."""
+    for path in paths:
+        file_format = detect_format(path) if input_format == "auto" else input_format
+        with open(path, encoding="utf-8") as f:
+            if file_format == "html":
+                yield path, f.read(), True, None
+                continue
+            for line in f:
+                line = line.rstrip("\n")
+                if file_format == "jsonl":
+                    if not line.strip():
+                        continue
+                    text, error = parse_jsonl_record(line, field)
+                    yield path, text, False, error
+                else:
+                    yield path, line, False, None
+
+
+def process_batch(
+    mode: str, batch: list[tuple[int, str, str, bool, str | None]], options: dict
+):
+    """Process one batch of records in a worker and return their output lines."""
+    valid = [record for record in batch if record[4] is None]
+    if mode == "translate":
+        try:
+            translations = translate_texts(
+                [text for _, _, text, _, _ in valid],
+                options["target"],
+                options["source"],
+            )
+            results = [(translation, None) for translation in translations]
+        except TranslationError as e:
+            results = [(None, str(e))] * len(valid)
+    else:
+        results = []
+        for _, _, text, is_html, _ in valid:
+            try:
+                if mode == "romaji":
+                    if is_html:
+                        result = process_html(text, romaji_markup(_katsu))
+                    else:
+                        result = _katsu.romaji(text)
+                elif mode == "furigana" and is_html:
+                    result = process_html(text, furigana_markup(_katsu))
+                else:
+                    result = transform_line(text) if text else None
+                results.append((result, None))
+            except Exception as e:
+                results.append((None, str(e)))
+
+    results = iter(results)
+    lines = []
+    for index, source, _, _, read_error in batch:
+        result, error = (None, read_error) if read_error else next(results)
+        record = {"index": index, "source": source, "result": result}
+        if error:
+            record["error"] = error
+        lines.append(orjson.dumps(record) + b"\n")
+    return b"".join(lines), sum(len(text) for _, _, text, _, _ in batch)
+
+
+def completed_records(output: str) -> int:
+    """Count the records already written, dropping a trailing partial line."""
+    if not os.path.exists(output):
+        return 0
+    count = 0
+    valid_size = 0
+    with open(output, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            count += 1
+            valid_size += len(line)
+    if valid_size != os.path.getsize(output):
+        with open(output, "r+b") as f:
+            f.truncate(valid_size)
+    return count
+
+
+def error_records(output: str) -> set[int]:
+    """Indices of the records written with an error."""
+    indices = set()
+    with open(output, "rb") as f:
+        for line in f:
+            record = orjson.loads(line)
+            if record.get("error"):
+                indices.add(record["index"])
+    return indices
+
+
+def work_items(records, size: int, kept_lines=None, retry=frozenset()):
+    """Yield batches of records to process, in input order.
+
+    Records that already have an output line without error yield that line
+    (bytes) from `kept_lines` instead, unless their index is in `retry`.
+    """
+    batch = []
+    for record in records:
+        if kept_lines is not None:
+            line = next(kept_lines, None)
+            if line is not None and record[0] not in retry:
+                if batch:
+                    yield batch
+                    batch = []
+                yield line
+                continue
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run(args) -> int:
+    done = completed_records(args.output) if not args.restart else 0
+    retry = error_records(args.output) if done and args.retry_errors else set()
+    records = (
+        (index, source, text, is_html or args.html, error)
+        for index, (source, text, is_html, error) in enumerate(
+            read_records(args.inputs, args.format, args.field)
+        )
+    )
+    options = {"target": args.target, "source": args.source}
+
+    kept = None
+    if retry:
+        # rewrite the output, keeping the lines that succeeded
+        kept = open(args.output, "rb")
+        output = args.output + ".retry"
+        mode = "wb"
+        items = work_items(records, args.batch_size, islice(kept, done), retry)
+    else:
+        output = args.output
+        mode = "ab" if done else "wb"
+        items = work_items(islice(records, done, None), args.batch_size)
+
+    processed = 0
+    characters = 0
+    started = last_report = time.monotonic()
+    # load the dictionary once so forked workers share it
+    preload()
+    with Pool(args.workers, initializer=_init_worker) as pool, open(
+        output, mode
+    ) as out:
+        pending = deque()
+
+        def submit(limit: int):
+            while limit > 0:
+                item = next(items, None)
+                if item is None:
+                    return
+                if isinstance(item, bytes):
+                    pending.append((0, item))
+                else:
+                    task = pool.apply_async(process_batch, (args.mode, item, options))
+                    pending.append((len(item), task))
+                limit -= 1
+
+        # keep a bounded window of batches in flight so memory stays flat
+        submit(args.workers * 2)
+        while pending:
+            count, task = pending.popleft()
+            if isinstance(task, bytes):
+                out.write(task)
+                submit(1)
+                continue
+            lines, size = task.get()
+            out.write(lines)
+            out.flush()
+            processed += count
+            characters += size
+            submit(1)
+
+            now = time.monotonic()
+            if now - last_report >= args.report_interval:
+                last_report = now
+                report(processed, characters, now - started, done)
+
+    if kept is not None:
+        kept.close()
+        os.replace(output, args.output)
+    report(processed, characters, time.monotonic() - started, done - len(retry))
+    return 0
+
+
+def report(processed: int, characters: int, elapsed: float, skipped: int):
+    elapsed = max(elapsed, 1e-9)
+    print(
+        f"{processed} records ({skipped} resumed) in {elapsed:.1f}s: "
+        f"{processed / elapsed:.1f} records/s, {characters / elapsed:.0f} chars/s",
+        file=sys.stderr,
+    )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("mode", choices=MODES)
+    parser.add_argument("inputs", nargs="+", help="input files (.txt, .jsonl, .html)")
+    parser.add_argument("-o", "--output", required=True, help="output JSONL file")
+    parser.add_argument(
+        "--format", choices=("auto", "text", "jsonl", "html"), default="auto"
+    )
+    parser.add_argument("--field", default="text", help="JSONL field to process")
+    parser.add_argument(
+        "--html", action="store_true", help="treat every record as HTML"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--target", default="en", help="translation target language")
+    parser.add_argument("--source", default=None, help="translation source language")
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="overwrite the output instead of resuming",
+    )
+    parser.add_argument(
+        "--retry-errors",
+        action="store_true",
+        help="when resuming, process records written with an error again",
+    )
+    parser.add_argument("--report-interval", type=float, default=10.0)
+    return run(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
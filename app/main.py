@@ -5,12 +5,11 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app._route import router
 from app._helpers import app
+from app._server import serve
 
 app.include_router(router)
 
 if __name__ == "__main__":
-    import uvicorn
-
     port = int(os.getenv("PORT", "3097"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
-    uvicorn.run(app, host="0.0.0.0")
+    workers = int(os.getenv("WORKERS", "1"))
+    serve(app, host="0.0.0.0", port=port, workers=workers)